@@ -3,6 +3,8 @@ import { exec } from "child_process";
 import { spawn } from "child_process";
 
 const IMAGE_SERVER = "http://localhost:8100";
+// Startup includes model load + warmup (SYBIL_LAZY=1 on the server skips it)
+const RESTART_TIMEOUT_MS = 180000;
 
 async function proxyGet(path: string) {
   const res = await fetch(`${IMAGE_SERVER}${path}`, { cache: "no-store" });
@@ -92,17 +94,20 @@ export async function POST(req: Request) {
         });
         child.unref();
 
-        // Wait for server to come up
-        await new Promise((resolve) => setTimeout(resolve, 3000));
-
-        // Probe health
-        try {
-          const res = await fetch(`${IMAGE_SERVER}/health`, { cache: "no-store" });
-          const health = await res.json();
-          return NextResponse.json({ success: true, data: { restarted: true, health } });
-        } catch {
-          return NextResponse.json({ success: true, data: { restarted: true, health: null } });
+        // Poll health until the server is listening. It loads, compiles and
+        // warms up the model before it starts accepting connections.
+        const deadline = Date.now() + RESTART_TIMEOUT_MS;
+        while (Date.now() < deadline) {
+          await new Promise((resolve) => setTimeout(resolve, 2000));
+          try {
+            const res = await fetch(`${IMAGE_SERVER}/health`, { cache: "no-store" });
+            const health = await res.json();
+            return NextResponse.json({ success: true, data: { restarted: true, health } });
+          } catch {
+            // Not up yet
+          }
         }
+        return NextResponse.json({ success: true, data: { restarted: true, health: null } });
       }
 
       default:
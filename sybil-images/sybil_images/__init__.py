@@ -0,0 +1 @@
+"""Sybil Image Generation Service package; the FastAPI app lives in core."""
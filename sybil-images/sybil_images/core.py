@@ -0,0 +1,966 @@
+"""
+Sybil Image Generation Service core: model lifecycle, batching and endpoints.
+FastAPI app using SDXL Turbo for generating profile pictures and banners.
+Loads the model at startup (SYBIL_LAZY=1 defers it to the first request).
+Prompt styles come from the pack in style_packs/ named by SYBIL_STYLE_PACK.
+"""
+
+import os
+import time
+import hashlib
+import importlib
+import importlib.util
+import asyncio
+import uuid
+import random
+import shutil
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+from contextlib import asynccontextmanager, nullcontext
+from dataclasses import dataclass, field
+from typing import NamedTuple
+
+# Allocator config has to be in place before torch initializes CUDA
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512")
+
+import torch
+import torchvision
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+
+from .counters import SharedCounters
+
+if torch.cuda.is_available():
+    torch.cuda.set_per_process_memory_fraction(float(os.environ.get("SYBIL_CUDA_MEM_FRACTION", "0.9")))
+
+# Output directory for generated images (sybil-images/output)
+OUTPUT_DIR = Path(__file__).resolve().parent.parent / "output"
+OUTPUT_DIR.mkdir(exist_ok=True)
+
+
+@dataclass
+class ModelHolder:
+    """Everything load_model() builds, dropped together by unload_model()."""
+    pipe: object = None
+    img2img_pipe: object = None
+    deepcache_helper: object = None
+    cpu_bf16: bool = False  # set when IPEX converted the UNet/VAE to bf16
+    compiled: bool = False  # set when torch.compile wrapped the UNet/VAE decode
+    # One RNG per batch slot, on the model's device so initial noise is sampled
+    # there. Only the UNet thread touches these, one batch at a time.
+    generators: list = field(default_factory=list)
+    unet_stream: object = None
+    vae_stream: object = None
+    loaded: bool = False
+
+    def clear(self):
+        """Drop every reference so the weights can be freed."""
+        self.pipe = None
+        self.img2img_pipe = None
+        self.deepcache_helper = None
+        self.cpu_bf16 = False
+        self.compiled = False
+        self.generators = []
+        self.unet_stream = None
+        self.vae_stream = None
+        self.loaded = False
+
+
+model = ModelHolder()
+
+# Load at startup unless SYBIL_LAZY=1, in which case the first request loads it
+LAZY_LOAD = os.environ.get("SYBIL_LAZY", "0") == "1"
+
+# Optional UNet quantization ("int4" uses nunchaku, CUDA only)
+QUANT_MODE = os.environ.get("SYBIL_QUANT", "").lower()
+INT4_CKPT = os.environ.get(
+    "SYBIL_INT4_CKPT",
+    "nunchaku-tech/nunchaku-sdxl-turbo/svdq-int4_r32-sdxl-turbo.safetensors",
+)
+
+# DeepCache reuses deep UNet features across adjacent steps (set 0 to disable)
+DEEPCACHE_ENABLED = os.environ.get("SYBIL_DEEPCACHE", "1") != "0"
+
+# Text encoder outputs per prompt string; sized to the style pools plus a
+# small LRU tail for custom prompts
+PROMPT_EMBED_EXTRA = 16
+prompt_embed_cache: OrderedDict[str, tuple[torch.Tensor, torch.Tensor]] = OrderedDict()
+
+# torch.compile the UNet/VAE on CUDA (set 0 to disable). On CUDA, warmup calls
+# at each fixed output shape pay the compile cost and fill the caching
+# allocator's pools during load
+COMPILE_ENABLED = os.environ.get("SYBIL_COMPILE", "1") != "0"
+WARMUP_SHAPES = [(512, 512), (1024, 256)]
+
+# SYBIL_RUNTIME=ort runs on ONNX Runtime + TensorRT when CUDA is available
+RUNTIME = os.environ.get("SYBIL_RUNTIME", "torch").lower()
+TRT_CACHE_DIR = OUTPUT_DIR.parent / "trt_cache"
+ONNX_MODEL_DIR = OUTPUT_DIR.parent / "onnx_model"
+
+# Approximate prompt cache: near-duplicate prompts resume from a cached latent,
+# re-noised to the midpoint so only the last half of the steps run.
+# Opt-in since a hit makes output depend on what was generated before.
+APPROX_CACHE_ENABLED = os.environ.get("SYBIL_APPROX_CACHE", "0") == "1"
+APPROX_CACHE_SIZE = 64
+APPROX_CACHE_THRESHOLD = 0.92
+APPROX_CACHE_STRENGTH = 0.5
+prompt_cache: list[dict] = []
+
+
+class Job(NamedTuple):
+    """One queued generation request; future receives its image."""
+    prompt: str
+    seed: int
+    width: int
+    height: int
+    future: asyncio.Future
+
+
+# Micro-batching: concurrent requests of the same size share one pipe() call
+MAX_BATCH_SIZE = int(os.environ.get("SYBIL_MAX_BATCH", "4"))
+BATCH_WINDOW_SECONDS = 0.02
+request_queue: asyncio.Queue | None = None
+batcher_task: asyncio.Task | None = None
+decode_tasks: set[asyncio.Task] = set()
+
+# Model work runs on two fixed threads: the current CUDA stream and torch.compile's
+# CUDA graphs are both per-thread. On CUDA the UNet thread denoises on unet_stream
+# while the VAE thread decodes the previous batch on vae_stream.
+denoise_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sybil-unet")
+decode_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sybil-vae")
+
+# Registry of PNGs in OUTPUT_DIR, oldest first: (filename, size, mtime, type).
+# Built from disk at startup, then kept in sync by the endpoints so /stats and
+# /recent don't scan the directory. registry_version is the shared output
+# version it reflects; another worker's change makes it stale and the next
+# read rescans.
+generated_files: deque[tuple[str, int, float, str]] = deque()
+output_dir_bytes = 0
+registry_version = -1  # never synced
+
+# Uptime + generation counters (shared across uvicorn workers, opened in lifespan)
+SERVER_START_TIME = time.time()
+COUNTERS_PATH = OUTPUT_DIR.parent / ".sybil_counters"
+counters: SharedCounters | None = None
+
+
+def get_device():
+    """Get the best available device."""
+    if torch.backends.mps.is_available():
+        return "mps"
+    elif torch.cuda.is_available():
+        return "cuda"
+    return "cpu"
+
+
+def pipeline_fingerprint() -> str:
+    """Everything besides the request inputs that changes the rendered pixels.
+
+    Derived from config and installed packages the same way load_model()
+    decides, so the image cache can be checked without a loaded model.
+    """
+    device = get_device()
+    use_ort = device == "cuda" and RUNTIME == "ort"
+    compiled = device == "cuda" and COMPILE_ENABLED and not use_ort
+    bf16 = device == "cpu" and importlib.util.find_spec("intel_extension_for_pytorch") is not None
+    deepcache = DEEPCACHE_ENABLED and not use_ort and not compiled and importlib.util.find_spec("DeepCache") is not None
+    return "|".join([
+        device,
+        "ort" if use_ort else "torch",
+        "int4" if QUANT_MODE == "int4" and device == "cuda" and not use_ort else "fp",
+        f"bf16={bf16}",
+        f"deepcache={deepcache}",
+        f"approx={APPROX_CACHE_ENABLED and not use_ort}",
+        f"noise={'cpu' if use_ort else device}",
+    ])
+
+
+PIPELINE_FINGERPRINT = pipeline_fingerprint()
+
+
+def load_torch_pipeline(device: str):
+    """Load the diffusers pipeline; returns (pipe, compiled)."""
+    from diffusers import AutoPipelineForText2Image
+
+    extra = {}
+    if QUANT_MODE == "int4" and device == "cuda":
+        # INT4 UNet; VAE and text encoders stay FP16
+        from nunchaku.models.unets.unet_sdxl import NunchakuSDXLUNet2DConditionModel
+
+        print(f"[SybilImages] Using INT4 UNet from {INT4_CKPT}")
+        extra["unet"] = NunchakuSDXLUNet2DConditionModel.from_pretrained(INT4_CKPT)
+    elif QUANT_MODE:
+        print(f"[SybilImages] SYBIL_QUANT={QUANT_MODE} not supported on {device}, loading FP16")
+
+    pipe = AutoPipelineForText2Image.from_pretrained(
+        "stabilityai/sdxl-turbo",
+        torch_dtype=torch.float16 if device != "cpu" else torch.float32,
+        variant="fp16" if device != "cpu" else None,
+        **extra,
+    )
+    pipe = pipe.to(device)
+    if device == "cuda" and pipe.vae.config.force_upcast:
+        # SDXL's VAE overflows in fp16. decode_latents() owns decoding on CUDA, so
+        # keep the VAE fp32 for good instead of upcasting and recasting every call,
+        # which would reallocate its weights under the compiled CUDA graph.
+        pipe.vae.to(dtype=torch.float32)
+    pipe.unet.to(memory_format=torch.channels_last)
+    pipe.vae.to(memory_format=torch.channels_last)
+
+    if device == "cpu":
+        try:
+            import intel_extension_for_pytorch as ipex
+        except ImportError:
+            print("[SybilImages] intel_extension_for_pytorch not installed, running fp32 on CPU")
+        else:
+            pipe.unet = ipex.optimize(pipe.unet.eval(), dtype=torch.bfloat16, inplace=True)
+            pipe.vae = ipex.optimize(pipe.vae.eval(), dtype=torch.bfloat16, inplace=True)
+            model.cpu_bf16 = True
+
+    compiled = device == "cuda" and COMPILE_ENABLED
+    if compiled:
+        # reduce-overhead records a CUDA graph per input shape. Pin shapes
+        # static (only WARMUP_SHAPES x batch sizes ever occur) and make room
+        # for every combination in dynamo's cache.
+        torch._dynamo.config.cache_size_limit = max(
+            torch._dynamo.config.cache_size_limit, 2 * len(WARMUP_SHAPES) * MAX_BATCH_SIZE
+        )
+        # nunchaku's INT4 UNet runs its own kernels, so only the VAE is compiled
+        if "unet" not in extra:
+            pipe.unet = torch.compile(pipe.unet, mode="reduce-overhead", fullgraph=True, dynamic=False)
+        pipe.vae.decode = torch.compile(pipe.vae.decode, mode="reduce-overhead", fullgraph=True, dynamic=False)
+
+    # DeepCache's per-step branching can't live inside a fullgraph compile
+    if DEEPCACHE_ENABLED and not compiled:
+        try:
+            from DeepCache import DeepCacheSDHelper
+        except ImportError:
+            print("[SybilImages] DeepCache not installed, running full UNet every step")
+        else:
+            model.deepcache_helper = DeepCacheSDHelper(pipe=pipe)
+            model.deepcache_helper.set_params(cache_interval=2, cache_branch_id=0)
+            model.deepcache_helper.enable()
+
+    return pipe, compiled
+
+
+def load_ort_pipeline():
+    """Load SDXL Turbo on ONNX Runtime with the TensorRT execution provider.
+
+    The ONNX export happens once and is saved to ONNX_MODEL_DIR; later starts
+    load it from there.
+    """
+    from optimum.onnxruntime import ORTStableDiffusionXLPipeline
+
+    options = {
+        "provider": "TensorrtExecutionProvider",
+        "provider_options": {
+            "trt_fp16_enable": True,
+            "trt_engine_cache_enable": True,
+            "trt_engine_cache_path": str(TRT_CACHE_DIR),
+        },
+    }
+    if (ONNX_MODEL_DIR / "model_index.json").exists():
+        return ORTStableDiffusionXLPipeline.from_pretrained(ONNX_MODEL_DIR, **options)
+
+    print(f"[SybilImages] Exporting SDXL Turbo to ONNX at {ONNX_MODEL_DIR} (first run only)...")
+    pipe = ORTStableDiffusionXLPipeline.from_pretrained("stabilityai/sdxl-turbo", export=True, **options)
+    # Save beside the target and rename, so an interrupted export isn't picked up next start
+    tmp_dir = ONNX_MODEL_DIR.with_name(f"{ONNX_MODEL_DIR.name}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    pipe.save_pretrained(tmp_dir)
+    shutil.rmtree(ONNX_MODEL_DIR, ignore_errors=True)
+    os.replace(tmp_dir, ONNX_MODEL_DIR)
+    return pipe
+
+
+def load_model():
+    """Load the SDXL Turbo pipeline into the model holder. Call on the UNet thread."""
+    if model.loaded:
+        return
+
+    device = get_device()
+    use_ort = device == "cuda" and RUNTIME == "ort"
+    print(f"[SybilImages] Loading SDXL Turbo on {device}{' (onnxruntime)' if use_ort else ''}...")
+
+    if use_ort:
+        # TensorRT builds one engine per input shape, so build them all now
+        model.pipe = load_ort_pipeline()
+        warmup_batch_sizes = range(1, MAX_BATCH_SIZE + 1)
+    else:
+        model.pipe, model.compiled = load_torch_pipeline(device)
+        if model.compiled:
+            # Capture the CUDA graph for every shape the batcher can produce
+            warmup_batch_sizes = range(1, MAX_BATCH_SIZE + 1)
+        elif device == "cuda":
+            # The max batch sizes the allocator pools; batch 1 is the common single request
+            warmup_batch_sizes = sorted({1, MAX_BATCH_SIZE})
+        else:
+            warmup_batch_sizes = []
+
+    # Disable safety checker for speed (these are abstract/non-human images)
+    model.pipe.safety_checker = None
+
+    if device == "cuda" and not use_ort:
+        model.unet_stream = torch.cuda.Stream()
+        model.vae_stream = torch.cuda.Stream()
+
+    generator_device = "cpu" if use_ort else device
+    model.generators = [torch.Generator(device=generator_device) for _ in range(MAX_BATCH_SIZE)]
+
+    if APPROX_CACHE_ENABLED and not use_ort:
+        from diffusers import AutoPipelineForImage2Image
+
+        # Shares modules with pipe, no extra weights loaded
+        model.img2img_pipe = AutoPipelineForImage2Image.from_pipe(model.pipe)
+
+    if warmup_batch_sizes:
+        warmup_model(warmup_batch_sizes)
+
+    model.loaded = True
+    print("[SybilImages] Model loaded successfully.")
+
+
+def warmup_model(batch_sizes):
+    """Run one throwaway generation per output shape and batch size."""
+    for width, height in WARMUP_SHAPES:
+        for batch_size in batch_sizes:
+            print(f"[SybilImages] Warming up {width}x{height} x{batch_size}...")
+            # Otherwise the previous warmup's entry is a similarity-1.0 hit and
+            # this call warms the img2img path instead of txt2img
+            prompt_cache.clear()
+            result, ready = denoise_batch(["warmup"] * batch_size, [0] * batch_size, width, height)
+            if ready is not None:
+                decode_executor.submit(decode_latents, result, ready).result()
+    prompt_cache.clear()
+
+
+def unload_model():
+    """Free GPU/MPS memory by unloading the model. Call on the UNet thread.
+
+    A compiled model's CUDA graph trees live per thread and keep their memory
+    pool and static buffers until dynamo is reset, so reset it on both model
+    threads first; a reload then compiles into an empty dynamo cache.
+    """
+    if model.deepcache_helper is not None:
+        model.deepcache_helper.disable()
+    if model.compiled:
+        decode_executor.submit(torch._dynamo.reset).result()
+        torch._dynamo.reset()
+    prompt_cache.clear()
+    prompt_embed_cache.clear()
+    model.clear()
+
+    if torch.backends.mps.is_available():
+        torch.mps.empty_cache()
+    elif torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+    import gc
+    gc.collect()
+    print("[SybilImages] Model unloaded, memory freed.")
+
+
+def model_autocast():
+    """bf16 autocast when the CPU model was IPEX-optimized, otherwise a no-op."""
+    if model.cpu_bf16:
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return nullcontext()
+
+
+def encode_prompts(prompts: list[str]):
+    """Return (prompt_embeds, pooled_embeds) for prompts, encoding only new ones."""
+    missing = list(dict.fromkeys(p for p in prompts if p not in prompt_embed_cache))
+    if missing:
+        embeds, _, pooled, _ = model.pipe.encode_prompt(
+            missing, device=model.pipe.device, do_classifier_free_guidance=False
+        )
+        for i, p in enumerate(missing):
+            prompt_embed_cache[p] = (embeds[i:i + 1], pooled[i:i + 1])
+
+    entries = [prompt_embed_cache[p] for p in prompts]
+    for p in prompts:
+        prompt_embed_cache.move_to_end(p)
+    limit = len(AVATAR_STYLES) + len(BANNER_STYLES) + PROMPT_EMBED_EXTRA
+    while len(prompt_embed_cache) > limit:
+        prompt_embed_cache.popitem(last=False)
+
+    return torch.cat([e[0] for e in entries]), torch.cat([e[1] for e in entries])
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Collapse case and whitespace so trivially different prompts share a key."""
+    return " ".join(prompt.lower().split())
+
+
+def lookup_prompt_cache(pooled_embeds, width: int, height: int) -> list[dict | None]:
+    """Find the most similar cached entry per prompt, or None below threshold."""
+    candidates = [e for e in prompt_cache if e["size"] == (width, height)]
+    if not candidates:
+        return [None] * len(pooled_embeds)
+    query = torch.nn.functional.normalize(pooled_embeds.float(), dim=-1)
+    sims = query @ torch.stack([e["emb"] for e in candidates]).T
+    best_sim, best_idx = sims.max(dim=1)
+    return [
+        candidates[i] if sim > APPROX_CACHE_THRESHOLD else None
+        for sim, i in zip(best_sim.tolist(), best_idx.tolist())
+    ]
+
+
+def store_prompt_cache(prompt: str, pooled_embed, latents, width: int, height: int):
+    """Cache a prompt's final latent, evicting the least-used entry when full."""
+    key = normalize_prompt(prompt)
+    if any(e["key"] == key and e["size"] == (width, height) for e in prompt_cache):
+        return
+    if len(prompt_cache) >= APPROX_CACHE_SIZE:
+        # Every hit saves the same number of steps, so least-beneficial
+        # reduces to least-used; min() keeps the oldest on ties
+        prompt_cache.remove(min(prompt_cache, key=lambda e: e["hits"]))
+    prompt_cache.append({
+        "key": key,
+        "size": (width, height),
+        "emb": torch.nn.functional.normalize(pooled_embed.float(), dim=-1),
+        "latents": latents.clone(),
+        "hits": 0,
+    })
+
+
+def run_batch(prompts: list[str], seeds: list[int], width: int, height: int):
+    """Denoise a batch, reloading first if /unload dropped the model; see denoise_batch()."""
+    if not model.loaded:
+        load_model()
+    return denoise_batch(prompts, seeds, width, height)
+
+
+def denoise_batch(prompts: list[str], seeds: list[int], width: int, height: int):
+    """Run pipe() for a batch of prompts sharing the same size.
+
+    Returns (images, None) with uint8 CPU image tensors, or on CUDA
+    (latents, event) where the latents are left for decode_latents() once the
+    event fires.
+    """
+    output_type = "pt" if model.vae_stream is None else "latent"
+    stream = torch.cuda.stream(model.unet_stream) if model.unet_stream is not None else nullcontext()
+    with stream, model_autocast():
+        generators = [g.manual_seed(s) for g, s in zip(model.generators, seeds)]
+        prompt_embeds, pooled_embeds = encode_prompts(prompts)
+
+        use_approx = model.img2img_pipe is not None
+        cached = [None] * len(prompts)
+        if use_approx:
+            cached = lookup_prompt_cache(pooled_embeds, width, height)
+        misses = [i for i, e in enumerate(cached) if e is None]
+        hits = [i for i, e in enumerate(cached) if e is not None]
+        images = [None] * len(prompts)
+
+        if misses:
+            final_latents = {}
+
+            def capture_latents(p, step, timestep, callback_kwargs):
+                if step == p.num_timesteps - 1:
+                    final_latents["latents"] = callback_kwargs["latents"]
+                return callback_kwargs
+
+            result = model.pipe(
+                prompt_embeds=prompt_embeds[misses],
+                pooled_prompt_embeds=pooled_embeds[misses],
+                num_inference_steps=4,
+                guidance_scale=0.0,
+                width=width,
+                height=height,
+                generator=[generators[i] for i in misses],
+                output_type=output_type,
+                callback_on_step_end=capture_latents if use_approx else None,
+            ).images
+            for j, i in enumerate(misses):
+                images[i] = result[j]
+                if use_approx:
+                    store_prompt_cache(prompts[i], pooled_embeds[i], final_latents["latents"][j], width, height)
+
+        if hits:
+            # Re-noise cached latents with this request's seed, then denoise the tail
+            result = model.img2img_pipe(
+                image=torch.stack([cached[i]["latents"] for i in hits]),
+                prompt_embeds=prompt_embeds[hits],
+                pooled_prompt_embeds=pooled_embeds[hits],
+                strength=APPROX_CACHE_STRENGTH,
+                num_inference_steps=4,
+                guidance_scale=0.0,
+                generator=[generators[i] for i in hits],
+                output_type=output_type,
+            ).images
+            for j, i in enumerate(hits):
+                images[i] = result[j]
+                cached[i]["hits"] += 1
+
+        batch = torch.stack(images)
+        if output_type == "pt":
+            return to_uint8_cpu(batch), None
+        return batch, model.unet_stream.record_event()
+
+
+def decode_latents(latents, ready):
+    """Decode a latent batch to uint8 CPU tensors on vae_stream, mirroring pipe()'s own decode."""
+    pipe, vae_stream = model.pipe, model.vae_stream
+    with torch.cuda.stream(vae_stream):
+        vae_stream.wait_event(ready)
+        # Keep the allocator from handing this block back to unet_stream mid-decode
+        latents.record_stream(vae_stream)
+
+        # The VAE is kept fp32 on CUDA (see load_torch_pipeline), latents are fp16
+        latents = latents.to(pipe.vae.dtype)
+        image = pipe.vae.decode(latents / pipe.vae.config.scaling_factor, return_dict=False)[0]
+
+        if getattr(pipe, "watermark", None) is not None:
+            image = pipe.watermark.apply_watermark(image)
+        return to_uint8_cpu(pipe.image_processor.postprocess(image, output_type="pt"))
+
+
+def to_uint8_cpu(images) -> list[torch.Tensor]:
+    """Convert a [0, 1] image batch (any float dtype) to per-image uint8 CHW tensors on the CPU."""
+    return list((images.float().clamp(0, 1) * 255).round().to(torch.uint8).cpu())
+
+
+def resolve_jobs(group: list[Job], images=None, error: Exception | None = None):
+    """Hand each job in a batch its image, or the batch's error."""
+    for i, job in enumerate(group):
+        if job.future.done():
+            continue
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(images[i])
+
+
+async def finish_batch(group: list[Job], latents, ready):
+    """Decode a denoised batch on the VAE thread and resolve its jobs."""
+    loop = asyncio.get_running_loop()
+    try:
+        images = await loop.run_in_executor(decode_executor, decode_latents, latents, ready)
+    except Exception as e:
+        resolve_jobs(group, error=e)
+        return
+    resolve_jobs(group, images)
+
+
+async def unload_when_idle():
+    """Unload once every in-flight batch, decode included, has finished."""
+    if decode_tasks:
+        await asyncio.gather(*decode_tasks, return_exceptions=True)
+    # FIFO behind any UNet work still running on the denoise thread
+    await asyncio.get_running_loop().run_in_executor(denoise_executor, unload_model)
+
+
+async def batcher():
+    """Drain the request queue, coalescing jobs into batched pipe() calls.
+
+    A bare future on the queue is an /unload request; it is handled here,
+    after the batches ahead of it, so no new batch can start mid-unload.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        jobs = [await request_queue.get()]
+        deadline = loop.time() + BATCH_WINDOW_SECONDS
+        while len(jobs) < MAX_BATCH_SIZE and not isinstance(jobs[-1], asyncio.Future):
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                jobs.append(await asyncio.wait_for(request_queue.get(), timeout=timeout))
+            except asyncio.TimeoutError:
+                break
+        unload_request = jobs.pop() if isinstance(jobs[-1], asyncio.Future) else None
+
+        # Group by output size; only same-shaped latents can share a batch
+        groups: dict[tuple[int, int], list[Job]] = {}
+        for job in jobs:
+            if not job.future.cancelled():
+                groups.setdefault((job.width, job.height), []).append(job)
+
+        for (width, height), group in groups.items():
+            try:
+                result, ready = await loop.run_in_executor(
+                    denoise_executor, run_batch, [j.prompt for j in group], [j.seed for j in group], width, height
+                )
+            except Exception as e:
+                resolve_jobs(group, error=e)
+                continue
+            if ready is None:
+                resolve_jobs(group, result)
+            else:
+                # Decode in the background so the next batch's UNet overlaps it
+                task = asyncio.create_task(finish_batch(group, result, ready))
+                decode_tasks.add(task)
+                task.add_done_callback(decode_tasks.discard)
+
+        if unload_request is not None:
+            try:
+                await unload_when_idle()
+            except Exception as e:
+                if not unload_request.done():
+                    unload_request.set_exception(e)
+            else:
+                # The /unload handler may have been cancelled while we waited
+                if not unload_request.done():
+                    unload_request.set_result(None)
+
+
+def on_batcher_done(task: asyncio.Task):
+    """Log a batcher crash and fail every request still queued behind it."""
+    if task.cancelled():
+        return
+    print(f"[SybilImages] Batcher stopped: {task.exception()!r}")
+    error = RuntimeError("image batcher is not running")
+    while not request_queue.empty():
+        item = request_queue.get_nowait()
+        future = item if isinstance(item, asyncio.Future) else item.future
+        if not future.done():
+            future.set_exception(error)
+
+
+async def enqueue(item):
+    """Queue a Job or /unload future for the batcher, failing fast if it died."""
+    if batcher_task.done():
+        raise RuntimeError("image batcher is not running")
+    await request_queue.put(item)
+
+
+def save_png(image: torch.Tensor, filepath: Path) -> os.stat_result:
+    """Encode a uint8 CHW tensor as PNG with fast compression and write it; runs off the event loop."""
+    png = torchvision.io.encode_png(image, compression_level=1)
+    filepath.write_bytes(png.numpy().tobytes())
+    return filepath.stat()
+
+
+def image_cache_path(prompt: str, seed: int, width: int, height: int) -> Path:
+    """Content-addressed cache location; output is a pure function of these inputs
+    plus the pipeline's configuration."""
+    key = hashlib.blake2s(
+        f"{PIPELINE_FINGERPRINT}|{prompt}|{seed}|{width}|{height}".encode(), digest_size=16
+    ).hexdigest()
+    return OUTPUT_DIR / f"cache_{key}.png"
+
+
+def copy_output(src: Path, dst: Path) -> os.stat_result:
+    """Copy src to a new inode at dst, so dst gets its own mtime."""
+    # Copy beside dst and rename into place so an existing inode is never rewritten
+    tmp = dst.with_name(f".{dst.name}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        shutil.copyfile(src, tmp)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    os.replace(tmp, dst)
+    return dst.stat()
+
+
+def link_output(src: Path, dst: Path) -> os.stat_result:
+    """Hardlink src to dst, copying instead where the filesystem can't link."""
+    try:
+        os.link(src, dst)
+    except (FileNotFoundError, FileExistsError):
+        raise
+    except OSError:
+        return copy_output(src, dst)
+    return dst.stat()
+
+
+def store_cached_image(src: Path, cache_path: Path):
+    """Publish src under its cache key, leaving an existing entry untouched."""
+    try:
+        link_output(src, cache_path)
+    except FileExistsError:
+        # A concurrent identical request got there first; same pixels either way
+        pass
+
+
+def file_type_for(filename: str) -> str:
+    """Classify an output file by its filename prefix."""
+    return "avatar" if filename.startswith("avatar_") else "banner" if filename.startswith("banner_") else "unknown"
+
+
+def note_output_change():
+    """Bump the shared output version after this worker changed OUTPUT_DIR.
+
+    The registry stays current only if no other worker changed it since the
+    last sync; otherwise it is left stale for sync_registry() to rescan.
+    """
+    global registry_version
+    version = counters.bump_output_version()
+    if version == registry_version + 1:
+        registry_version = version
+
+
+def register_file(filename: str, stat: os.stat_result):
+    """Record a newly written PNG in the registry."""
+    global output_dir_bytes
+    generated_files.append((filename, stat.st_size, stat.st_mtime, file_type_for(filename)))
+    output_dir_bytes += stat.st_size
+    note_output_change()
+
+
+def scan_output_dir():
+    """Rebuild the registry from disk in a single directory pass."""
+    global output_dir_bytes
+    entries = []
+    with os.scandir(OUTPUT_DIR) as it:
+        for entry in it:
+            # cache_ files are hardlinks of outputs already listed, not outputs themselves
+            if entry.name.endswith(".png") and not entry.name.startswith("cache_") and entry.is_file():
+                stat = entry.stat()
+                entries.append((entry.name, stat.st_size, stat.st_mtime, file_type_for(entry.name)))
+    entries.sort(key=lambda e: e[2])
+    generated_files.clear()
+    generated_files.extend(entries)
+    output_dir_bytes = sum(e[1] for e in entries)
+
+
+def sync_registry():
+    """Rescan OUTPUT_DIR if another worker changed it since the registry was built."""
+    global registry_version
+    # Read the version before scanning so a change mid-scan triggers another rescan
+    version = counters.output_version()
+    if version != registry_version:
+        scan_output_dir()
+        registry_version = version
+
+
+def delete_output_files() -> int:
+    """Unlink every PNG in OUTPUT_DIR in a single directory pass.
+
+    Returns the number of outputs deleted; cache_ hardlinks are removed too
+    but not counted, matching what /recent lists.
+    """
+    deleted = 0
+    with os.scandir(OUTPUT_DIR) as it:
+        for entry in it:
+            if entry.name.endswith(".png") and entry.is_file():
+                os.unlink(entry.path)
+                if not entry.name.startswith("cache_"):
+                    deleted += 1
+    return deleted
+
+
+def name_seed(name: str, kind: bytes) -> int:
+    """Derive a 32-bit seed from a name, stable across restarts unlike hash()."""
+    return int.from_bytes(hashlib.blake2s(name.encode(), digest_size=4, person=kind).digest(), "little")
+
+
+async def generate_image(prompt: str, seed: int, width: int, height: int):
+    """Queue a generation job for the batcher and wait for its image."""
+    future = asyncio.get_running_loop().create_future()
+    await enqueue(Job(prompt, seed, width, height, future))
+    return await future
+
+
+async def render_image(prefix: str, prompt: str, seed: int, width: int, height: int, cacheable: bool):
+    """Write a new output PNG, reusing a cached render of the same inputs if any.
+
+    Only cacheable (named, deterministic-seed) requests touch the cache. A
+    hit needs no loaded model, so it never triggers a lazy load or reload.
+    Hits are copied rather than linked: a hardlink would share the cached
+    render's mtime, which the registry and scan_output_dir() order by.
+
+    Returns (filename, filepath, cache_hit).
+    """
+    filename = f"{prefix}_{uuid.uuid4().hex[:12]}.png"
+    filepath = OUTPUT_DIR / filename
+
+    if cacheable:
+        try:
+            stat = await asyncio.to_thread(copy_output, image_cache_path(prompt, seed, width, height), filepath)
+            register_file(filename, stat)
+            return filename, filepath, True
+        except FileNotFoundError:
+            pass
+
+    image = await generate_image(prompt, seed, width, height)
+    stat = await asyncio.to_thread(save_png, image, filepath)
+    if cacheable:
+        await asyncio.to_thread(store_cached_image, filepath, image_cache_path(prompt, seed, width, height))
+
+    register_file(filename, stat)
+    return filename, filepath, False
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global request_queue, batcher_task, counters
+    print("[SybilImages] Service starting on port 8100...")
+    counters = SharedCounters(COUNTERS_PATH)
+    sync_registry()
+    if not LAZY_LOAD:
+        # Load on the UNet thread so warmup's CUDA graphs belong to it
+        await asyncio.get_running_loop().run_in_executor(denoise_executor, load_model)
+    request_queue = asyncio.Queue()
+    batcher_task = asyncio.create_task(batcher())
+    batcher_task.add_done_callback(on_batcher_done)
+    yield
+    batcher_task.cancel()
+    try:
+        await batcher_task
+    except asyncio.CancelledError:
+        pass
+    await unload_when_idle()
+    counters.close()
+
+
+app = FastAPI(title="Sybil Image Service", lifespan=lifespan, default_response_class=ORJSONResponse)
+
+
+# --- Style pack ---
+
+STYLE_PACKS = ("photoreal",)
+STYLE_PACK = os.environ.get("SYBIL_STYLE_PACK", "photoreal")
+if STYLE_PACK not in STYLE_PACKS:
+    raise ValueError(f"SYBIL_STYLE_PACK must be one of {STYLE_PACKS}, got {STYLE_PACK!r}")
+_style_pack = importlib.import_module(f"{__package__}.style_packs.{STYLE_PACK}")
+
+# Copied so PUT /styles can replace them without touching the pack module
+AVATAR_STYLES = list(_style_pack.AVATAR_STYLES)
+BANNER_STYLES = list(_style_pack.BANNER_STYLES)
+AVATAR_SUFFIX = _style_pack.AVATAR_SUFFIX
+BANNER_SUFFIX = _style_pack.BANNER_SUFFIX
+
+
+# --- Request models ---
+
+class GenerateRequest(BaseModel):
+    name: str = ""
+    style: str = ""
+
+
+class UpdateStylesRequest(BaseModel):
+    avatar_styles: list[str] | None = None
+    banner_styles: list[str] | None = None
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "model_loaded": model.loaded, "device": get_device()}
+
+
+@app.post("/generate-avatar")
+async def generate_avatar(req: GenerateRequest):
+    """Generate a 512x512 profile picture."""
+    try:
+        style = req.style or random.choice(AVATAR_STYLES)
+        prompt = f"{style}, {AVATAR_SUFFIX}"
+        if req.name:
+            # Don't put the name literally in the prompt, use it as seed variation
+            seed = name_seed(req.name, b"avatar")
+        else:
+            seed = random.randint(0, 2**32 - 1)
+
+        filename, filepath, cache_hit = await render_image("avatar", prompt, seed, 512, 512, cacheable=bool(req.name))
+
+        if not cache_hit:
+            counters.increment("total_generated", "avatars_generated")
+
+        return {
+            "success": True,
+            "file_path": str(filepath),
+            "filename": filename,
+            "size": "512x512",
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/generate-banner")
+async def generate_banner(req: GenerateRequest):
+    """Generate a 1024x256 banner image."""
+    try:
+        style = req.style or random.choice(BANNER_STYLES)
+        prompt = f"{style}, {BANNER_SUFFIX}"
+        if req.name:
+            seed = name_seed(req.name, b"banner")
+        else:
+            seed = random.randint(0, 2**32 - 1)
+
+        filename, filepath, cache_hit = await render_image("banner", prompt, seed, 1024, 256, cacheable=bool(req.name))
+
+        if not cache_hit:
+            counters.increment("total_generated", "banners_generated")
+
+        return {
+            "success": True,
+            "file_path": str(filepath),
+            "filename": filename,
+            "size": "1024x256",
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/unload")
+async def unload():
+    """Free GPU memory after batch processing."""
+    # Goes through the batcher so it lands after queued batches and their decodes
+    done = asyncio.get_running_loop().create_future()
+    await enqueue(done)
+    await done
+    return {"success": True, "message": "Model unloaded"}
+
+
+@app.get("/styles")
+async def get_styles():
+    """Return current avatar and banner style prompts."""
+    return {"avatar_styles": AVATAR_STYLES, "banner_styles": BANNER_STYLES}
+
+
+@app.put("/styles")
+async def update_styles(req: UpdateStylesRequest):
+    """Update avatar and/or banner style prompts."""
+    global AVATAR_STYLES, BANNER_STYLES
+    if req.avatar_styles is not None:
+        if len(req.avatar_styles) == 0:
+            raise HTTPException(status_code=400, detail="avatar_styles cannot be empty")
+        AVATAR_STYLES = req.avatar_styles
+    if req.banner_styles is not None:
+        if len(req.banner_styles) == 0:
+            raise HTTPException(status_code=400, detail="banner_styles cannot be empty")
+        BANNER_STYLES = req.banner_styles
+    return {"success": True, "avatar_styles": len(AVATAR_STYLES), "banner_styles": len(BANNER_STYLES)}
+
+
+@app.get("/stats")
+async def get_stats():
+    """Return generation statistics and server info."""
+    sync_registry()
+    return {
+        **counters.snapshot(),
+        "output_dir_size_mb": round(output_dir_bytes / (1024 * 1024), 2),
+        "model_loaded": model.loaded,
+        "device": get_device(),
+        "uptime_seconds": round(time.time() - SERVER_START_TIME),
+    }
+
+
+@app.get("/recent")
+async def get_recent(limit: int = 20):
+    """Return recent generated files, newest first."""
+    sync_registry()
+    result = []
+    for filename, size, mtime, file_type in islice(reversed(generated_files), max(limit, 0)):
+        result.append({
+            "filename": filename,
+            "type": file_type,
+            "size_kb": round(size / 1024, 1),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(mtime)),
+        })
+    return {"files": result}
+
+
+@app.post("/clear-output")
+async def clear_output():
+    """Delete all PNG files from the output directory."""
+    global output_dir_bytes
+    deleted = await asyncio.to_thread(delete_output_files)
+    generated_files.clear()
+    output_dir_bytes = 0
+    note_output_change()
+    return {"success": True, "deleted": deleted}
@@ -0,0 +1,82 @@
+"""
+Generation counters shared by every uvicorn worker.
+
+The counters live in a small mmap'd file and are updated under an flock, so
+`uvicorn --workers N` reports one coherent set of totals instead of N shards.
+The same file carries an output version that every worker bumps when it adds
+or deletes output files, so each can tell when its file registry is stale.
+"""
+
+import fcntl
+import mmap
+import multiprocessing
+import os
+import struct
+from contextlib import contextmanager
+from pathlib import Path
+
+COUNTER_NAMES = ("total_generated", "avatars_generated", "banners_generated")
+
+# Slot 0 is the pid of the process that launched the workers, slot 1 the
+# output version; the rest are counters
+_HEADER = 2
+_LAYOUT = struct.Struct(f"{_HEADER + len(COUNTER_NAMES)}Q")
+
+
+class SharedCounters:
+    """uint64 counters in an mmap'd file, incremented atomically across processes."""
+
+    def __init__(self, path: Path):
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self._fd).st_size < _LAYOUT.size:
+            os.ftruncate(self._fd, _LAYOUT.size)
+        self._mm = mmap.mmap(self._fd, _LAYOUT.size)
+
+        # uvicorn spawns workers from one supervisor; a plain `python server.py`
+        # has no multiprocessing parent and owns the counters itself. A new
+        # launch sees a different owner and starts from zero.
+        launcher = multiprocessing.parent_process() or multiprocessing.current_process()
+        with self._locked():
+            values = _LAYOUT.unpack_from(self._mm)
+            if values[0] != launcher.pid:
+                _LAYOUT.pack_into(self._mm, 0, launcher.pid, *([0] * (_HEADER - 1 + len(COUNTER_NAMES))))
+
+    @contextmanager
+    def _locked(self):
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def increment(self, *names: str):
+        """Add one to each named counter in a single locked update."""
+        with self._locked():
+            values = list(_LAYOUT.unpack_from(self._mm))
+            for name in names:
+                values[_HEADER + COUNTER_NAMES.index(name)] += 1
+            _LAYOUT.pack_into(self._mm, 0, *values)
+
+    def snapshot(self) -> dict[str, int]:
+        """Read all counters at once."""
+        with self._locked():
+            values = _LAYOUT.unpack_from(self._mm)
+        return dict(zip(COUNTER_NAMES, values[_HEADER:]))
+
+    def output_version(self) -> int:
+        """Current output version; it changes whenever any worker edits the output dir."""
+        with self._locked():
+            return _LAYOUT.unpack_from(self._mm)[1]
+
+    def bump_output_version(self) -> int:
+        """Record an output dir change and return the new version."""
+        with self._locked():
+            values = list(_LAYOUT.unpack_from(self._mm))
+            values[1] += 1
+            _LAYOUT.pack_into(self._mm, 0, *values)
+        return values[1]
+
+    def close(self):
+        """Unmap the counter file; the totals stay on disk for other workers."""
+        self._mm.close()
+        os.close(self._fd)
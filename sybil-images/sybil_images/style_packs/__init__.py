@@ -0,0 +1 @@
+"""Prompt style packs, selected with SYBIL_STYLE_PACK."""
@@ -0,0 +1,30 @@
+"""Photorealistic people and places."""
+
+AVATAR_SUFFIX = "photorealistic, 8k, detailed skin texture, DSLR photograph"
+BANNER_SUFFIX = "photorealistic, 8k, DSLR photograph, sharp detail"
+
+AVATAR_STYLES = [
+    "portrait photo of a young person, natural lighting, casual, looking at camera, shallow depth of field",
+    "professional headshot, studio lighting, neutral background, confident expression, sharp focus",
+    "candid selfie of a person outdoors, golden hour, warm tones, natural smile",
+    "portrait of a person in a coffee shop, soft ambient lighting, bokeh background",
+    "close-up portrait, dramatic side lighting, moody atmosphere, sharp details",
+    "casual portrait photo, urban street background, natural daylight, relaxed pose",
+    "portrait of a person at sunset, warm orange light, silhouette edges, peaceful expression",
+    "indoor portrait, window light, soft shadows, clean modern room background",
+    "portrait photo of a person, overcast day, muted tones, thoughtful expression, natural skin",
+    "headshot portrait, ring light, clean background, friendly expression, high detail",
+]
+
+BANNER_STYLES = [
+    "aerial photograph of a city skyline at golden hour, warm light, wide panoramic",
+    "landscape photograph of mountains and lake, moody clouds, cinematic wide shot",
+    "urban street photography, rain reflections, neon signs, night, wide format",
+    "ocean waves crashing on rocky coast, dramatic sky, panoramic photograph",
+    "dense forest canopy from above, misty morning, green tones, wide shot",
+    "desert highway stretching to horizon, sunset, golden light, panoramic",
+    "rooftop view of city at night, bokeh lights, wide angle photograph",
+    "autumn forest path, golden leaves, soft light filtering through trees, wide",
+    "beach at sunrise, calm water, pastel sky, minimal and serene, panoramic",
+    "snow-covered mountain range, blue hour, crisp detail, cinematic wide shot",
+]